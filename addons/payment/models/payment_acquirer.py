@@ -8,7 +8,7 @@ from dateutil import relativedelta
 import pprint
 
 from odoo import api, exceptions, fields, models, _, SUPERUSER_ID
-from odoo.tools import consteq, float_round, image_process, ustr
+from odoo.tools import consteq, float_round, image_process_sizes, ustr
 from odoo.addons.base.models import ir_module
 from odoo.exceptions import ValidationError
 from odoo.tools.misc import DEFAULT_SERVER_DATETIME_FORMAT
@@ -536,15 +536,13 @@ class PaymentIcon(models.Model):
         for vals in vals_list:
             if 'image' in vals:
                 image = ustr(vals['image'] or '').encode('utf-8')
-                vals['image_payment_form'] = image_process(image, size=(45,30))
-                vals['image'] = image_process(image, size=(64,64))
+                vals['image'], vals['image_payment_form'] = image_process_sizes(image, [(64, 64), (45, 30)])
         return super(PaymentIcon, self).create(vals_list)
 
     def write(self, vals):
         if 'image' in vals:
             image = ustr(vals['image'] or '').encode('utf-8')
-            vals['image_payment_form'] = image_process(image, size=(45,30))
-            vals['image'] = image_process(image, size=(64,64))
+            vals['image'], vals['image_payment_form'] = image_process_sizes(image, [(64, 64), (45, 30)])
         return super(PaymentIcon, self).write(vals)
 
 class PaymentTransaction(models.Model):
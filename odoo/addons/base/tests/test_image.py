@@ -3,6 +3,8 @@
 
 import base64
 import binascii
+import io
+import random
 
 from PIL import Image, ImageDraw, PngImagePlugin
 
@@ -68,6 +70,14 @@ class TestImage(TransactionCase):
         image_base64 = tools.image_to_base64(image, 'PNG')
         self.assertEqual(image_base64, self.base64_1x1_png)
 
+        # large images are encoded by blocks while they are saved
+        image = Image.new('RGB', (1920, 1080), color=self.bg_color)
+        ImageDraw.Draw(image).ellipse(xy=[(0, 0), (1920, 1080)], fill=self.fill_color)
+        for image_format in ('PNG', 'JPEG', 'GIF'):
+            stream = io.BytesIO()
+            image.save(stream, format=image_format)
+            self.assertEqual(tools.image_to_base64(image, image_format), base64.b64encode(stream.getvalue()), "%s encoded by blocks" % image_format)
+
     def test_02_image_fix_orientation(self):
         """Test that the orientation of images is correct."""
 
@@ -137,6 +147,24 @@ class TestImage(TransactionCase):
             count = count + 1
         self.assertEqual(count, 10, "ensure the loop is ran")
 
+        res = tools.image_process(self.base64_1920x1080_jpeg, size=(3000, 2000), output_format='PNG')
+        self.assertEqual(tools.base64_to_image(res).format, 'PNG', "still convert if smaller than size")
+
+        # right/top orientation: the image is rotated by a quarter turn
+        b64_image = tools.image_to_base64(Image.new('RGB', (500, 1000)), 'PNG', exif=self._get_exif_orientation(6))
+        image = tools.base64_to_image(tools.image_process(b64_image, size=(600, 1000)))
+        self.assertEqual(image.size, (600, 300), "PNG orientation is fixed before comparing to size")
+
+        # the size is read from the header, without decoding the whole image,
+        # from a new source since a result could be cached for the others
+        base64_image = tools.image_to_base64(Image.new('RGB', (300, 200)), 'JPEG')
+
+        def base64_to_image(base64_source):
+            raise AssertionError("the image should not be decoded")
+        self.patch(tools.image, 'base64_to_image', base64_to_image)
+        res = tools.image_process(base64_image, size=(3000, 2000))
+        self.assertEqual(res, base64_image, "return base64_source if smaller than size")
+
     def test_12_image_process_verify_resolution(self):
         """Test the verify_resolution parameter of image_process."""
         res = tools.image_process(self.base64_1920x1080_jpeg, verify_resolution=True)
@@ -145,6 +173,23 @@ class TestImage(TransactionCase):
         with self.assertRaises(ValueError, msg="size excessive"):
             tools.image_process(base64_image_excessive, verify_resolution=True)
 
+        # the size is read from the header, before decoding the whole base64
+        # data, which would fail here because of the truncated padding
+        with self.assertRaises(ValueError, msg="size excessive, read from header"):
+            tools.image_process(base64_image_excessive + b'A', verify_resolution=True)
+
+        image = tools.base64_to_image(tools.image_process(base64_image_excessive, size=(128, 128)))
+        self.assertEqual(image.width, 128, "size excessive, resize without verify_resolution")
+
+        # the whole image is decoded to verify it, even if it is small enough
+        # to be returned unchanged
+        image = Image.new('RGB', (400, 400), color=self.bg_color)
+        ImageDraw.Draw(image).ellipse(xy=[(0, 0), (400, 400)], fill=self.fill_color)
+        image_data = base64.b64decode(tools.image_to_base64(image, 'JPEG'))
+        base64_image_truncated = base64.b64encode(image_data[:len(image_data) // 2])
+        with self.assertRaises(OSError, msg="image file is truncated"):
+            tools.image_process(base64_image_truncated, size=(1920, 1920), verify_resolution=True)
+
     def test_13_image_process_quality(self):
         """Test the quality parameter of image_process."""
 
@@ -167,6 +212,11 @@ class TestImage(TransactionCase):
         res = tools.image_process(image)
         self.assertLessEqual(len(res), len(image))
 
+        # CASE: PNG optimize is only applied if asked
+        res = tools.image_process(self.base64_1920x1080_png, size=(1024, 0))
+        res_optimized = tools.image_process(self.base64_1920x1080_png, size=(1024, 0), optimize=True)
+        self.assertLessEqual(len(res_optimized), len(res))
+
     def test_14_image_process_crop(self):
         """Test the crop parameter of image_process."""
 
@@ -257,9 +307,84 @@ class TestImage(TransactionCase):
         image = tools.base64_to_image(tools.image_process(self.base64_image_1080_1920_tiff, quality=95))
         self.assertEqual(image.format, 'JPEG', "unsupported format to JPEG")
 
+    def test_17_image_process_jpeg_draft(self):
+        """Test that JPEG images loaded at a reduced scale are resized correctly."""
+        image = tools.ImageProcess(self.base64_1920x1080_jpeg, size=(192, 108))
+        width, height = image.image.size
+        self.assertLess(width, 1920, "image is loaded at a reduced scale")
+        self.assertLess(height, 1080, "image is loaded at a reduced scale")
+        self.assertGreaterEqual(width, 2 * 192, "image is loaded at least twice as large as the size")
+        self.assertGreaterEqual(height, 2 * 108, "image is loaded at least twice as large as the size")
+
+        image = tools.base64_to_image(tools.image_process(self.base64_1920x1080_jpeg, size=(192, 108)))
+        self.assertEqual(image.size, (192, 108), "resize to given size")
+
+        image = tools.base64_to_image(tools.image_process(self.base64_1920x1080_jpeg, size=(0, 108), crop='center'))
+        self.assertEqual(image.size, (192, 108), "resize with crop, set width from ratio")
+
+        # right/top orientation: the image is rotated by a quarter turn
+        b64_image = self._get_exif_colored_square_b64(6, ((0, 0, 255),) * 4, 600)
+        image = tools.base64_to_image(tools.image_process(b64_image, size=(60, 0)))
+        self.assertEqual(image.size, (60, 60), "resize with orientation fixed")
+
+    def test_18_image_process_sizes(self):
+        """Test that image_process_sizes gives the sizes of image_process, within 1 pixel."""
+        sizes = [(192, 108), (1920, 1080), (0, 512), (3000, 2000), (1024, 1024), (64, 64), (180, 0), (0, 38), False]
+        base64_705x1918_jpeg = tools.image_to_base64(Image.new('RGB', (705, 1918)), 'JPEG')
+        for base64_source in (self.base64_1920x1080_jpeg, self.base64_1080x1920_png, base64_705x1918_jpeg):
+            results = tools.image_process_sizes(base64_source, sizes)
+            self.assertEqual(len(results), len(sizes))
+            for size, result in zip(sizes, results):
+                expected = tools.base64_to_image(tools.image_process(base64_source, size=size)).size
+                width, height = tools.base64_to_image(result).size
+                self.assertLessEqual(abs(width - expected[0]), 1, "%s - width of image_process" % (size,))
+                self.assertLessEqual(abs(height - expected[1]), 1, "%s - height of image_process" % (size,))
+
+        self.assertEqual(tools.image_process_sizes(self.base64_svg, [(64, 64)]), [self.base64_svg], "return base64_source if format is SVG")
+        self.assertEqual(tools.image_process_sizes(False, [(64, 64)]), [False], "return False if base64_source is falsy")
+
+    def test_19_image_process_cache(self):
+        """Test that resized images are cached."""
+        res = tools.image_process(self.base64_1920x1080_png, size=(192, 0))
+        self.assertIs(tools.image_process(self.base64_1920x1080_png, size=(192, 0)), res, "same resize is cached")
+        self.assertIsNot(tools.image_process(self.base64_1920x1080_png, size=(192, 0), quality=95), res, "parameters are part of the key")
+        self.assertEqual(tools.base64_to_image(tools.image_process(self.base64_1080x1920_png, size=(192, 0))).size, (192, 341), "source is part of the key")
+
+        base64_image = tools.image_to_base64(Image.new('RGB', (30, 20)), 'BMP')
+        res = tools.image_process(base64_image, size=(0, 0), verify_resolution=True)
+        self.assertIsNot(tools.image_process(base64_image, size=(0, 0), verify_resolution=True), res, "no resize is not cached")
+
+        # noise does not compress, so the result stays large
+        rng = random.Random(0)
+        image = Image.frombytes('L', (256, 256), bytes(rng.randrange(256) for _ in range(256 * 256)))
+        base64_image = tools.image_to_base64(image, 'BMP')
+        res = tools.image_process(base64_image, size=(1024, 1024))
+        self.assertGreater(len(res), tools.IMAGE_PROCESS_CACHE_MAX_RESULT_SIZE)
+        self.assertIsNot(tools.image_process(base64_image, size=(1024, 1024)), res, "large result is not cached")
+
     def test_20_image_data_uri(self):
         """Test that image_data_uri is working as expected."""
         self.assertEqual(tools.image_data_uri(self.base64_1x1_png), 'data:image/png;base64,' + self.base64_1x1_png.decode('ascii'))
+        self.assertEqual(tools.image_data_uri(self.base64_1920x1080_jpeg), 'data:image/jpg;base64,' + self.base64_1920x1080_jpeg.decode('ascii'))
+        self.assertEqual(tools.image_data_uri_bytes(self.base64_1x1_png), b'data:image/png;base64,' + self.base64_1x1_png)
+        self.assertEqual(tools.image_data_uri_bytes(self.base64_svg), b'data:image/svg+xml;base64,' + self.base64_svg)
+
+    def test_21_is_image_size_above(self):
+        """Test that is_image_size_above is working as expected."""
+        self.assertTrue(tools.is_image_size_above(self.base64_1920x1080_jpeg, self.base64_1x1_png))
+        self.assertFalse(tools.is_image_size_above(self.base64_1x1_png, self.base64_1920x1080_jpeg))
+        self.assertFalse(tools.is_image_size_above(self.base64_1920x1080_jpeg, self.base64_1920x1080_png))
+        self.assertTrue(tools.is_image_size_above(self.base64_1920x1080_png, self.base64_1080x1920_png))
+        self.assertFalse(tools.is_image_size_above(self.base64_svg, self.base64_1x1_png), "False for SVG")
+
+        # right/top orientation: the image is rotated by a quarter turn
+        b64_image = tools.image_to_base64(Image.new('RGB', (1920, 1080)), 'JPEG', exif=self._get_exif_orientation(6))
+        self.assertFalse(tools.is_image_size_above(b64_image, self.base64_1080x1920_png), "orientation is fixed")
+
+        # same for PNG, whose orientation is only read when decoding the image
+        b64_image = tools.image_to_base64(Image.new('RGB', (1920, 1080)), 'PNG', exif=self._get_exif_orientation(6))
+        self.assertFalse(tools.is_image_size_above(b64_image, self.base64_1080x1920_png), "orientation is fixed for PNG")
+        self.assertTrue(tools.is_image_size_above(b64_image, self.base64_1920x1080_png), "orientation is fixed for PNG")
 
     def _assertAlmostEqualSequence(self, rgb1, rgb2, delta=10):
         self.assertEqual(len(rgb1), len(rgb2))
@@ -275,10 +400,12 @@ class TestImage(TransactionCase):
         draw.rectangle(xy=[(size // 2, 0), (size, size // 2)], fill=colors[1])     # top/right
         draw.rectangle(xy=[(0, size // 2), (size // 2, size)], fill=colors[2])     # bottom/left
         draw.rectangle(xy=[(size // 2, size // 2), (size, size)], fill=colors[3])  # bottom/right
-        # Set the proper exif tag based on orientation params.
-        exif = b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x01\x00\x12\x01\x03\x00\x01\x00\x00\x00' + bytes([orientation]) + b'\x00\x00\x00\x00\x00\x00\x00'
         # The image image is saved with the exif tag.
-        return tools.image_to_base64(image, 'JPEG', exif=exif)
+        return tools.image_to_base64(image, 'JPEG', exif=self._get_exif_orientation(orientation))
+
+    def _get_exif_orientation(self, orientation):
+        # Set the proper exif tag based on orientation params.
+        return b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x01\x00\x12\x01\x03\x00\x01\x00\x00\x00' + bytes([orientation]) + b'\x00\x00\x00\x00\x00\x00\x00'
 
     def _orientation_test(self, orientation, colors, size, expected):
         # Generate the test image based on orientation and order of colors.
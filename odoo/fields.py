@@ -2086,6 +2086,8 @@ class Image(Binary):
         return image_process(value,
             size=(self.max_width, self.max_height),
             verify_resolution=self.verify_resolution,
+            # stored images are processed once and served many times
+            optimize=True,
         )
 
     def _process_related(self, value):
@@ -2,15 +2,25 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 import base64
 import binascii
+import hashlib
 import io
 
+# Pillow-SIMD is a drop-in replacement of Pillow providing vectorized
+# resampling filters, it is used transparently through the same import
 from PIL import Image, ImageOps
 # We can preload Ico too because it is considered safe
 from PIL import IcoImagePlugin
 
 from random import randrange
 
+try:
+    # SIMD implementation of base64, several times faster on large images
+    import pybase64 as _base64
+except ImportError:
+    _base64 = base64
+
 from odoo.exceptions import UserError
+from odoo.tools.lru import LRU
 from odoo.tools.translate import _
 
 
@@ -27,6 +37,12 @@ FILETYPE_BASE64_MAGICWORD = {
     b'P': 'svg+xml',
 }
 
+# Same mapping indexed by the first byte of the base64 data, to get the mime
+# subtype without allocating a slice nor hashing it
+_FILETYPE_BASE64_MAGICWORD_LUT = [
+    FILETYPE_BASE64_MAGICWORD.get(bytes([byte]), 'png').encode() for byte in range(256)
+]
+
 EXIF_TAG_ORIENTATION = 0x112
 # The target is to have 1st row/col to be top/left
 # Note: rotate is counterclockwise
@@ -46,10 +62,31 @@ EXIF_TAG_ORIENTATION_TO_TRANSPOSE_METHODS = {  # Initial side on 1st row/col:
 # 8K with a ratio up to 16:10, and almost all variants of 4320p
 IMAGE_MAX_RESOLUTION = 45e6
 
+# Resampling filter used to resize images. BICUBIC gives a result visually
+# equivalent to LANCZOS when reducing the size of an image, at a fraction of
+# the cost. Set `odoo.tools.image.IMAGE_RESAMPLE_FILTER` to `Image.LANCZOS` if
+# quality is paramount.
+IMAGE_RESAMPLE_FILTER = Image.BICUBIC
+
+# Length of the base64 data decoded to read the size of an image from its
+# header only. It has to be a multiple of 4 to be valid base64, and is large
+# enough to include the EXIF data that precedes the size in JPEG pictures.
+IMAGE_HEADER_BASE64_LENGTH = 64 * 1024
+
+# Results of the resizes done by `image_process`, keyed by a digest of the
+# source and the processing parameters. The same image is often resized to
+# the same size several times in a row, e.g. when it is shown many times on
+# a page. Only results up to `IMAGE_PROCESS_CACHE_MAX_RESULT_SIZE` bytes are
+# kept, which bounds the memory used by the cache to 16 MiB per worker and
+# keeps large one-off results, like the stored versions of uploaded images,
+# out of it.
+IMAGE_PROCESS_CACHE_MAX_RESULT_SIZE = 64 * 1024
+_image_process_cache = LRU(256)
+
 
 class ImageProcess():
 
-    def __init__(self, base64_source, verify_resolution=True):
+    def __init__(self, base64_source, verify_resolution=True, size=None, header=None):
         """Initialize the `base64_source` image for processing.
 
         :param base64_source: the original image base64 encoded
@@ -62,6 +99,19 @@ class ImageProcess():
             defined by `IMAGE_MAX_RESOLUTION`.
         :type verify_resolution: bool
 
+        :param size: the size the image is going to be resized to, if known.
+            For JPEG, it allows the decoder to directly load a reduced version
+            of the image, which is a lot faster than decoding it entirely. The
+            loaded image is always kept at least twice as large as the given
+            size, so the final resize can still be done with a good quality.
+            Falsy to load the image at its original size.
+        :type size: tuple (width, height)
+
+        :param header: the result of `_image_header` for `base64_source`, if
+            it has already been read by the caller. Default to reading it when
+            needed.
+        :type header: tuple (format, (width, height)) or False
+
         :return: self
         :rtype: ImageProcess
 
@@ -75,6 +125,13 @@ class ImageProcess():
             # don't process empty source or SVG
             self.image = False
         else:
+            # Read the size from the header first to reject excessive images
+            # before decoding the whole base64 data.
+            if verify_resolution and header is None:
+                header = _image_header(self.base64_source)
+            if verify_resolution and header:
+                self._verify_resolution(*header[1])
+
             self.image = base64_to_image(self.base64_source)
 
             # Original format has to be saved before fixing the orientation or
@@ -82,13 +139,50 @@ class ImageProcess():
             # the resulting image.
             self.original_format = (self.image.format or '').upper()
 
+            # If the header could not be read, the resolution is checked before
+            # the image is drafted because drafting reduces the size, and before
+            # the orientation is fixed because it loads the pixels.
+            if verify_resolution and not header:
+                self._verify_resolution(*self.image.size)
+
+            if size and self.original_format == 'JPEG':
+                self._draft(max_width=size[0] or 0, max_height=size[1] or 0)
+
             self.image = image_fix_orientation(self.image)
 
-            w, h = self.image.size
-            if verify_resolution and w * h > IMAGE_MAX_RESOLUTION:
-                raise ValueError(_("Image size excessive, uploaded images must be smaller than %s million pixels.") % str(IMAGE_MAX_RESOLUTION / 10e6))
+    def _verify_resolution(self, width, height):
+        """Make sure the given image size is not excessive.
+
+        :raise: ValueError if the image is larger than `IMAGE_MAX_RESOLUTION`
+        """
+        if width * height > IMAGE_MAX_RESOLUTION:
+            raise ValueError(_("Image size excessive, uploaded images must be smaller than %s million pixels.") % str(IMAGE_MAX_RESOLUTION / 10e6))
+
+    def _draft(self, max_width=0, max_height=0):
+        """Configure the JPEG decoder to load a reduced version of the image,
+        at least twice as large as the given size.
+
+        This has to be called before the image is loaded to have any effect.
 
-    def image_base64(self, quality=0, output_format=''):
+        :param max_width: max width the image will be resized to
+        :type max_width: int
+
+        :param max_height: max height the image will be resized to
+        :type max_height: int
+        """
+        w, h = self.image.size
+        if _image_is_transposed(self.image):
+            # The given size is relative to the image once its orientation has
+            # been fixed, which is a quarter turn away from the current one.
+            max_width, max_height = max_height, max_width
+        if not max_width and not max_height:
+            return
+        draft_width = 2 * (max_width or (w * max_height) // h)
+        draft_height = 2 * (max_height or (h * max_width) // w)
+        if draft_width and draft_height and (draft_width < w or draft_height < h):
+            self.image.draft(self.image.mode, (draft_width, draft_height))
+
+    def image_base64(self, quality=0, output_format='', optimize=False):
         """Return the base64 encoded image resulting of all the image processing
         operations that have been applied previously.
 
@@ -103,7 +197,7 @@ class ImageProcess():
             - for JPEG: 1 is worse, 95 is best. Values above 95 should be
                 avoided. Falsy values will fallback to 95, but only if the image
                 was changed, otherwise the original image is returned.
-            - for PNG: set falsy to prevent conversion to a WEB palette.
+            - for PNG: set falsy to prevent conversion to a palette.
             - for other formats: no effect.
         :type quality: int
 
@@ -112,6 +206,12 @@ class ImageProcess():
             PNG, other formats than those mentioned above are converted to JPEG.
         :type output_format: string
 
+        :param optimize: if True, spend more time to make PNG and GIF images as
+            small as possible. Otherwise PNG images are saved with the default
+            zlib compression level, which is several times faster. JPEG images
+            are always optimized since it is cheap.
+        :type optimize: bool
+
         :return: image base64 encoded or False
         :rtype: bytes or False
         """
@@ -132,16 +232,25 @@ class ImageProcess():
         opt = {'format': output_format}
 
         if output_format == 'PNG':
-            opt['optimize'] = True
+            if optimize:
+                opt['optimize'] = True
+            else:
+                opt['compress_level'] = 6
             if quality:
                 if output_image.mode != 'P':
-                    # Floyd Steinberg dithering by default
-                    output_image = output_image.convert('RGBA').convert('P', palette=Image.WEB, colors=256)
+                    # Fast octree works on RGB and RGBA, don't convert those
+                    # since it would copy the whole image for nothing.
+                    if output_image.mode not in ('RGB', 'RGBA'):
+                        output_image = output_image.convert('RGBA')
+                    # Fast octree gives a better palette than the WEB palette,
+                    # faster, and keeps the transparency. No dithering is
+                    # applied: PIL only dithers when mapping to a given palette.
+                    output_image = output_image.quantize(colors=256, method=Image.FASTOCTREE)
         if output_format == 'JPEG':
             opt['optimize'] = True
             opt['quality'] = quality or 95
         if output_format == 'GIF':
-            opt['optimize'] = True
+            opt['optimize'] = optimize
             opt['save_all'] = True
 
         if output_image.mode not in ["1", "L", "P", "RGB", "RGBA"] or (output_format == 'JPEG' and output_image.mode == 'RGBA'):
@@ -174,10 +283,11 @@ class ImageProcess():
         """
         if self.image and self.original_format != 'GIF' and (max_width or max_height):
             w, h = self.image.size
-            asked_width = max_width or (w * max_height) // h
-            asked_height = max_height or (h * max_width) // w
+            # the current size is a bound that never applies, `thumbnail` keeps the ratio
+            asked_width = max_width or w
+            asked_height = max_height or h
             if asked_width != w or asked_height != h:
-                self.image.thumbnail((asked_width, asked_height), Image.LANCZOS)
+                self.image.thumbnail((asked_width, asked_height), IMAGE_RESAMPLE_FILTER)
                 if self.image.width != w or self.image.height != h:
                     self.operationsCount += 1
         return self
@@ -255,14 +365,13 @@ class ImageProcess():
         if self.image:
             original = self.image
             color = (randrange(32, 224, 24), randrange(32, 224, 24), randrange(32, 224, 24))
-            self.image = Image.new('RGB', original.size)
-            self.image.paste(color, box=(0, 0) + original.size)
+            self.image = Image.new('RGB', original.size, color)
             self.image.paste(original, mask=original)
             self.operationsCount += 1
         return self
 
 
-def image_process(base64_source, size=(0, 0), verify_resolution=False, quality=0, crop=None, colorize=False, output_format=''):
+def image_process(base64_source, size=(0, 0), verify_resolution=False, quality=0, crop=None, colorize=False, output_format='', optimize=False):
     """Process the `base64_source` image by executing the given operations and
     return the result as a base64 encoded image.
     """
@@ -271,7 +380,37 @@ def image_process(base64_source, size=(0, 0), verify_resolution=False, quality=0
         # no operations have been requested
         return base64_source
 
-    image = ImageProcess(base64_source, verify_resolution)
+    # The header is read once, either to verify the resolution or to skip
+    # decoding small images, and is given to `ImageProcess`.
+    header = None
+    skip_small = size and not crop and not quality and not colorize and not verify_resolution
+    if verify_resolution or skip_small:
+        header = _image_header(base64_source)
+
+    if skip_small and header:
+        # for performance: don't decode the image if it would be returned
+        # unchanged because it is already smaller than the given size. Not
+        # when verifying the image, since the whole image has to be decoded to
+        # make sure it is valid.
+        original_format, (w, h) = header
+        if (
+            (not size[0] or w <= size[0]) and (not size[1] or h <= size[1])
+            and original_format in ('PNG', 'JPEG', 'GIF', 'ICO')
+            and output_format.upper() in ('', original_format)
+        ):
+            return base64_source
+
+    # Only cache resizes and not colorize, whose result is random. Text sources
+    # are not cached because they are returned as is when no operation is
+    # applied.
+    cache_key = None
+    if size and (size[0] or size[1]) and not colorize and isinstance(base64_source, bytes):
+        cache_key = (hashlib.sha1(base64_source).digest(), tuple(size), verify_resolution, quality, crop, output_format.upper(), optimize)
+        cached = _image_process_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    image = ImageProcess(base64_source, verify_resolution, size=size, header=header)
     if size:
         if crop:
             center_x = 0.5
@@ -285,7 +424,51 @@ def image_process(base64_source, size=(0, 0), verify_resolution=False, quality=0
             image.resize(max_width=size[0], max_height=size[1])
     if colorize:
         image.colorize()
-    return image.image_base64(quality=quality, output_format=output_format)
+    result = image.image_base64(quality=quality, output_format=output_format, optimize=optimize)
+    if cache_key and len(result) <= IMAGE_PROCESS_CACHE_MAX_RESULT_SIZE:
+        _image_process_cache[cache_key] = result
+    return result
+
+
+def image_process_sizes(base64_source, sizes, verify_resolution=False, quality=0, output_format='', optimize=False):
+    """Process the `base64_source` image to each of the given `sizes` and
+    return the results as base64 encoded images, in the same order as `sizes`.
+
+    The image is decoded only once, drafted to the largest size, and each size
+    is resized from that decoded image, which is a lot faster than calling
+    `image_process` for each size on the same source. Because JPEG images are
+    drafted to a different scale than `image_process` would for each size, the
+    results can differ from `image_process` by 1 pixel.
+
+    See `image_process` for the other parameters.
+
+    :param sizes: the sizes to resize the image to
+    :type sizes: list of tuple (width, height)
+
+    :return: the processed images base64 encoded
+    :rtype: list
+    """
+    if not base64_source:
+        return [base64_source] * len(sizes)
+
+    draft_size = None
+    if all(size and size[0] and size[1] for size in sizes):
+        # only draft if the largest size is known without the image size
+        draft_size = (max(size[0] for size in sizes), max(size[1] for size in sizes))
+    image = ImageProcess(base64_source, verify_resolution, size=draft_size)
+    base_image = image.image
+
+    results = []
+    for size in sizes:
+        if base_image:
+            # resize always starts from the decoded image, `thumbnail` changes
+            # the image in place
+            image.image = base_image.copy()
+            image.operationsCount = 0
+        if size:
+            image.resize(max_width=size[0], max_height=size[1])
+        results.append(image.image_base64(quality=quality, output_format=output_format, optimize=optimize))
+    return results
 
 
 # ----------------------------------------
@@ -390,6 +573,47 @@ def image_fix_orientation(image):
     return image
 
 
+def _image_is_transposed(image):
+    """Return whether fixing the orientation of the given `image` will swap its
+    width and height, without loading the image.
+
+    :param image: the source image
+    :type image: PIL.Image
+
+    :rtype: bool
+    """
+    # only JPEG reads its EXIF data without loading the image
+    exif = image._getexif() if (image.format or '').upper() == 'JPEG' and hasattr(image, '_getexif') else None
+    return bool(exif) and exif.get(EXIF_TAG_ORIENTATION, 0) in (5, 6, 7, 8)
+
+
+def _image_header(base64_source):
+    """Return the format and the size of the given `base64_source` image, with
+    its orientation fixed, by only decoding the beginning of the base64 data.
+
+    :param base64_source: the image base64 encoded
+    :type base64_source: string or bytes
+
+    :return: the image format (upper case) and size, or False if they could
+        not be read from the header
+    :rtype: tuple (format, (width, height)) or False
+    """
+    try:
+        image = Image.open(io.BytesIO(_base64.b64decode(base64_source[:IMAGE_HEADER_BASE64_LENGTH])))
+        if (image.format or '').upper() != 'JPEG' and 'exif' in image.info:
+            # the orientation can only be read without loading the image for
+            # JPEG, let the caller decode the image to fix its orientation
+            return False
+        w, h = image.size
+        if _image_is_transposed(image):
+            w, h = h, w
+        return (image.format or '').upper(), (w, h)
+    except Exception:
+        # truncated data can make PIL fail in many different ways, the caller
+        # falls back on decoding the whole image
+        return False
+
+
 def base64_to_image(base64_source):
     """Return a PIL image from the given `base64_source`.
 
@@ -402,11 +626,60 @@ def base64_to_image(base64_source):
     :raise: UserError if the base64 is incorrect or the image can't be identified by PIL
     """
     try:
-        return Image.open(io.BytesIO(base64.b64decode(base64_source)))
+        return Image.open(io.BytesIO(_base64.b64decode(base64_source)))
     except (OSError, binascii.Error):
         raise UserError(_("This file could not be decoded as an image file. Please try with a different file."))
 
 
+class _Base64WritableStream():
+    """Write-only file-like object encoding in base64 the data written to it.
+
+    Raw data is encoded by blocks of at least `BUFFER_SIZE` bytes as soon as
+    they are written, so the raw data never has to be held entirely in memory
+    next to its base64 version.
+    """
+    # multiple of 3 so each block is encoded without padding
+    BUFFER_SIZE = 3 * 64 * 1024
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._output = None
+
+    def write(self, data):
+        size = len(data)
+        if self._buffer or size < self.BUFFER_SIZE:
+            self._buffer += data
+            data = self._buffer
+        if len(data) >= self.BUFFER_SIZE:
+            encoded_size = len(data) - len(data) % 3
+            with memoryview(data) as view:
+                self._write_encoded(view[:encoded_size])
+                self._buffer = bytearray(view[encoded_size:])
+        return size
+
+    def _write_encoded(self, data):
+        encoded = _base64.b64encode(data)
+        if self._output is None:
+            # BytesIO shares its initial value instead of copying it, which
+            # matters when the whole image is written at once (e.g. JPEG)
+            self._output = io.BytesIO(encoded)
+            self._output.seek(0, io.SEEK_END)
+        else:
+            self._output.write(encoded)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        """Return the base64 encoded data written so far, the last block being
+        padded. Nothing can be written after that.
+        """
+        if self._buffer or self._output is None:
+            self._write_encoded(self._buffer)
+            self._buffer = bytearray()
+        return self._output.getvalue()
+
+
 def image_to_base64(image, format, **params):
     """Return a base64_image from the given PIL `image` using `params`.
 
@@ -419,9 +692,16 @@ def image_to_base64(image, format, **params):
     :return: the image base64 encoded
     :rtype: bytes
     """
+    if format.upper() in ('PNG', 'JPEG', 'GIF'):
+        # those formats are written sequentially, without seeking back
+        base64_stream = _Base64WritableStream()
+        image.save(base64_stream, format=format, **params)
+        return base64_stream.getvalue()
     stream = io.BytesIO()
     image.save(stream, format=format, **params)
-    return base64.b64encode(stream.getvalue())
+    # encode from a view of the buffer to avoid copying the saved image
+    with stream.getbuffer() as buffer:
+        return _base64.b64encode(buffer)
 
 
 def is_image_size_above(base64_source_1, base64_source_2):
@@ -433,9 +713,11 @@ def is_image_size_above(base64_source_1, base64_source_2):
     if base64_source_1[:1] in (b'P', 'P') or base64_source_2[:1] in (b'P', 'P'):
         # False for SVG
         return False
-    image_source = image_fix_orientation(base64_to_image(base64_source_1))
-    image_target = image_fix_orientation(base64_to_image(base64_source_2))
-    return image_source.width > image_target.width or image_source.height > image_target.height
+    header_source = _image_header(base64_source_1)
+    header_target = _image_header(base64_source_2)
+    source_width, source_height = header_source[1] if header_source else image_fix_orientation(base64_to_image(base64_source_1)).size
+    target_width, target_height = header_target[1] if header_target else image_fix_orientation(base64_to_image(base64_source_2)).size
+    return source_width > target_width or source_height > target_height
 
 
 def image_guess_size_from_field_name(field_name):
@@ -461,10 +743,19 @@ def image_data_uri(base64_source):
     (https://tools.ietf.org/html/rfc2397) for all kind of supported images
     (PNG, GIF, JPG and SVG), defaulting on PNG type if not mimetype detected.
     """
-    return 'data:image/%s;base64,%s' % (
-        FILETYPE_BASE64_MAGICWORD.get(base64_source[:1], 'png'),
-        base64_source.decode(),
-    )
+    return image_data_uri_bytes(base64_source).decode()
+
+
+def image_data_uri_bytes(base64_source):
+    """Same as `image_data_uri` but return bytes. Base64 data being ASCII, the
+    data URL is built without decoding or formatting it.
+    """
+    return b''.join([
+        b'data:image/',
+        _FILETYPE_BASE64_MAGICWORD_LUT[base64_source[0]] if base64_source else b'png',
+        b';base64,',
+        base64_source,
+    ])
 
 
 def get_saturation(rgb):
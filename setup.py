@@ -36,7 +36,10 @@ setup(
         'mock',
         'ofxparse',
         'passlib',
-        'pillow',  # windows binary http://www.lfd.uci.edu/~gohlke/pythonlibs/
+        # windows binary http://www.lfd.uci.edu/~gohlke/pythonlibs/
+        # pillow-simd built with CC="cc -mavx2" can replace it on x86 for
+        # faster image resizing (its PIL.__version__ has a ".postN" suffix)
+        'pillow',
         'polib',
         'psutil',  # windows binary code.google.com/p/psutil/downloads/list
         'psycopg2 >= 2.2',